@@ -0,0 +1,238 @@
+import contextlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import OptimizeError, SqlglotError
+from sqlglot.optimizer.scope import traverse_scope
+
+
+logger = logging.getLogger(__name__)
+
+DATABASE = "data/netflix.db"
+DERIVED_DATABASE = "data/.derived.db"
+MAX_ROWS = 200
+DB_POOL_SIZE = 4
+FETCH_CHUNK_SIZE = 50
+
+ALLOWED_TABLES = {"netflix_titles", "title_directors"}
+
+# json_each over the raw comma-separated directors column is rewritten to run over valid JSON array text.
+_DIRECTORS_JSON = sqlglot.parse_one(
+    "'[\"' || REPLACE(REPLACE(IFNULL(directors, ''), '\"', ''), ',', '\",\"') || '\"]'",
+    read="sqlite",
+)
+
+
+def _is_raw_directors(node: exp.Expression) -> bool:
+    if isinstance(node, exp.Coalesce) and len(node.expressions) == 1:
+        fallback = node.expressions[0]
+        if not (isinstance(fallback, exp.Literal) and fallback.is_string and fallback.this == ""):
+            return False
+        node = node.this
+    return isinstance(node, exp.Column) and not node.table and node.name.lower() == "directors"
+
+
+def _normalise_query(sql: str) -> str:
+    if not sql or not sql.strip():
+        raise ValueError("Empty SQL query.")
+
+    try:
+        statements = [
+            statement
+            for statement in sqlglot.parse(sql, read="sqlite")
+            if statement is not None and not isinstance(statement, exp.Semicolon)
+        ]
+    except SqlglotError as err:
+        raise ValueError(f"Could not parse SQL: {err}") from err
+    if len(statements) != 1:
+        raise ValueError("Multiple statements are not allowed.")
+
+    tree = statements[0]
+    if not isinstance(tree, exp.Query):
+        raise ValueError("Only SELECT statements (optionally starting with WITH) are allowed.")
+
+    # CTE names only count where that scope can see the CTE; otherwise a CTE named after a
+    # blocked table would whitelist real references to that table elsewhere in the query.
+    try:
+        scopes = traverse_scope(tree)
+    except OptimizeError as err:
+        raise ValueError(f"Could not resolve SQL scopes: {err}") from err
+    checked = set()
+    for scope in scopes:
+        cte_names = {name.lower() for name in scope.cte_sources}
+        for table in scope.tables:
+            checked.add(id(table))
+            if isinstance(table.this, exp.Anonymous):
+                if table.this.name.lower() != "json_each":
+                    raise ValueError(f"Table-valued function '{table.this.name}' is not allowed.")
+            elif table.name.lower() not in ALLOWED_TABLES and table.name.lower() not in cte_names:
+                raise ValueError(f"Access to table '{table.name}' is not allowed.")
+    if any(id(table) not in checked for table in tree.find_all(exp.Table)):
+        raise ValueError("Could not resolve every table reference in the query.")
+
+    for func in list(tree.find_all(exp.Anonymous)):
+        if func.name.lower() == "json_each" and len(func.expressions) == 1 and _is_raw_directors(func.expressions[0]):
+            func.expressions[0].replace(_DIRECTORS_JSON.copy())
+
+    # Cap the result inside SQLite so it stops stepping one row past the truncation threshold.
+    # Regenerating from the AST also gives repeat questions byte-identical SQL for the statement cache.
+    limited = exp.select("*").from_(tree.subquery()).limit(MAX_ROWS + 1)
+    return limited.sql(dialect="sqlite", comments=False)
+
+
+def _source_signature() -> tuple:
+    stat = os.stat(DATABASE)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _derived_signature():
+    try:
+        with contextlib.closing(sqlite3.connect(f"file:{DERIVED_DATABASE}?mode=ro", uri=True)) as conn:
+            return conn.execute("SELECT source_mtime_ns, source_size FROM build_info").fetchone()
+    except sqlite3.Error:
+        return None
+
+
+def _build_derived_database(signature: tuple):
+    # title_directors explodes the comma-separated directors column once, so director
+    # questions become an indexed aggregation instead of a per-query string split.
+    # It lives in an ignored sidecar so the tracked netflix.db is never written.
+    tmp_path = f"{DERIVED_DATABASE}.{os.getpid()}.tmp"
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp_path)
+    # uri=True makes the ATTACH below honour the file: URI even where SQLite lacks SQLITE_USE_URI.
+    with contextlib.closing(sqlite3.connect(f"file:{tmp_path}", uri=True)) as conn:
+        conn.execute("ATTACH DATABASE ? AS source", (f"file:{DATABASE}?mode=ro",))
+        conn.execute(
+            """
+            CREATE TABLE title_directors AS
+            SELECT show_id, TRIM(value) AS director
+            FROM source.netflix_titles,
+                 json_each('["' || REPLACE(REPLACE(IFNULL(directors, ''), '"', ''), ',', '","') || '"]')
+            WHERE TRIM(value) <> ''
+            """
+        )
+        conn.execute("CREATE INDEX idx_td ON title_directors(director)")
+        conn.execute("CREATE TABLE build_info (source_mtime_ns INTEGER, source_size INTEGER)")
+        conn.execute("INSERT INTO build_info VALUES (?, ?)", signature)
+        conn.commit()
+    os.replace(tmp_path, DERIVED_DATABASE)
+    logger.info("Rebuilt derived tables in %s", DERIVED_DATABASE)
+
+
+def _ensure_derived_database(signature: tuple) -> bool:
+    if _derived_signature() == signature:
+        return True
+    try:
+        _build_derived_database(signature)
+    except (sqlite3.Error, OSError) as err:
+        logger.warning("Could not build derived tables in %s: %s", DERIVED_DATABASE, err)
+        return False
+    return True
+
+
+def _close_idle_connections(pool: queue.Queue):
+    # Idle connections hold the sidecar open, which blocks replacing it on Windows.
+    while True:
+        try:
+            pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+
+_conn_pool = None
+_conn_pool_signature = None
+_conn_pool_lock = threading.Lock()
+
+
+def _open_connection() -> sqlite3.Connection:
+    # netflix.db is opened read-only; derived tables are resolved from the attached sidecar.
+    conn = sqlite3.connect(
+        f"file:{DATABASE}?mode=ro", uri=True, check_same_thread=False, cached_statements=256
+    )
+    conn.execute("PRAGMA temp_store=memory")
+    conn.execute("PRAGMA cache_size=-200000")
+    conn.execute("PRAGMA mmap_size=1073741824")
+    try:
+        conn.execute("ATTACH DATABASE ? AS derived", (f"file:{DERIVED_DATABASE}?mode=ro",))
+    except sqlite3.OperationalError as err:
+        logger.warning("Could not attach %s: %s", DERIVED_DATABASE, err)
+    # Walk every table b-tree once so the first user questions are served from the page cache.
+    for table in sorted(ALLOWED_TABLES):
+        try:
+            conn.execute(f"SELECT COUNT(*) FROM {table} NOT INDEXED").fetchone()
+        except sqlite3.OperationalError as err:
+            logger.warning("Could not prewarm %s: %s", table, err)
+    return conn
+
+
+def _get_conn_pool() -> queue.Queue:
+    # Streamlit runs each session on its own script thread; a small pool of long-lived
+    # connections keeps page caches warm without making sessions queue behind one another.
+    # The pool lives at module level, so it survives Streamlit reruns of the app script,
+    # and is rebuilt together with the derived tables whenever netflix.db changes.
+    global _conn_pool, _conn_pool_signature
+    signature = _source_signature()
+    with _conn_pool_lock:
+        if _conn_pool is None or _conn_pool_signature != signature:
+            if _conn_pool is not None:
+                _close_idle_connections(_conn_pool)
+            built = _ensure_derived_database(signature)
+            pool = queue.Queue()
+            for _ in range(DB_POOL_SIZE):
+                pool.put(_open_connection())
+            # Connections checked out from the old pool go back to it and are dropped with it.
+            # A failed rebuild leaves the signature unset so the next call tries again.
+            _conn_pool, _conn_pool_signature = pool, signature if built else None
+    return _conn_pool
+
+
+@contextlib.contextmanager
+def _connection():
+    pool = _get_conn_pool()
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+def execute_query(sql: str):
+    safe_sql = _normalise_query(sql)
+    logger.info("Executing SQL: %s", safe_sql)
+    with _connection() as conn:
+        cursor = conn.execute(safe_sql)
+        try:
+            columns = [desc[0] for desc in cursor.description] if cursor.description else []
+            rows = []
+            for batch in iter(lambda: cursor.fetchmany(FETCH_CHUNK_SIZE), []):
+                rows.extend(batch)
+        finally:
+            cursor.close()
+    if len(rows) > MAX_ROWS:
+        logger.warning("Result truncated to first %s rows to protect data.", MAX_ROWS)
+        rows = rows[:MAX_ROWS]
+    return columns, rows
+
+
+def summary() -> dict:
+    with _connection() as conn:
+        total_rows, unique_titles, latest_year = conn.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT title), MAX(release_year) FROM netflix_titles"
+        ).fetchone()
+        cursor = conn.execute(
+            "SELECT type, COUNT(*) AS count FROM netflix_titles GROUP BY type ORDER BY count DESC"
+        )
+        columns = [desc[0] for desc in cursor.description]
+        by_type = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return {
+        "total_rows": total_rows,
+        "unique_titles": unique_titles,
+        "latest_year": latest_year,
+        "by_type": by_type,
+    }
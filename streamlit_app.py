@@ -1,14 +1,22 @@
-import json
+import csv
+import hashlib
+import io
 import logging
 import os
-import sqlite3
+import threading
 from datetime import datetime
 from pathlib import Path
 
+import diskcache
+import orjson
 import pandas as pd
 import requests
 import streamlit as st
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+import db
+from db import execute_query
 
 
 logging.basicConfig(
@@ -21,31 +29,31 @@ load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = "gpt-4o-mini"
-DATABASE = "data/netflix.db"
 SUPPORT_TICKET_PATH = Path("data/support_tickets.csv")
-MAX_ROWS = 200
+SUMMARY_CACHE_PATH = Path("data/.summary_cache.json")
+AGENT_CACHE_DIR = Path("data/.agent_cache")
+TICKET_COLUMNS = ["ticket_id", "title", "description", "priority", "created_at"]
+RECENT_TICKET_COUNT = 10
+TICKET_TAIL_BYTES = 16384
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
 
 DATABASE_SCHEMA = """
 Table: netflix_titles
 Columns: show_id, type, title, directors, cast, countries, date_added, release_year, rating, duration, listed_in, description
+Table: title_directors
+Columns: show_id, director
 """
 
 SYSTEM_PROMPT = """You are DatabaseGPT, a helpful assistant that answers questions using the netflix_titles SQLite database.
 Rules:
-- Generate safe, single-statement, read-only SQL (SELECT ... or WITH ... SELECT) referencing only the netflix_titles table and its listed columns.
-- Treat directors as a comma-separated list; when counting or grouping by director, expand the list using a CTE with json_each and TRIM, converting the string into valid JSON, for example:
-  WITH director_cte AS (
-      SELECT
-          TRIM(value) AS director
-      FROM netflix_titles,
-           json_each(
-               '["'
-               || REPLACE(REPLACE(IFNULL(directors, ''), '"', ''), ',', '","')
-               || '"]'
-           )
-      WHERE director <> ''
-  )
+- Generate safe, single-statement, read-only SQL (SELECT ... or WITH ... SELECT) referencing only the netflix_titles and title_directors tables and their listed columns.
+- netflix_titles.directors is a comma-separated list; never split it yourself. title_directors holds one row per (show_id, director) pair, so when counting or grouping by director use it directly (joining netflix_titles on show_id if other columns are needed), for example:
+  SELECT director, COUNT(*) AS title_count
+  FROM title_directors
+  GROUP BY director
+  ORDER BY title_count DESC
 - Apply sensible LIMIT values (e.g., 10 or 20) unless the user requests more.
+- ask_database results are column-oriented: "columns" lists the column names and "column_values"[i] holds every value of "columns"[i] in row order.
 - When results indicate data quality issues, suggest creating a support ticket through the provided tool.
 Provide concise, markdown-formatted answers summarising the results."""
 
@@ -94,77 +102,99 @@ FUNCTIONS = [
         },
     },
 ]
+_FUNCTIONS_JSON = orjson.dumps(FUNCTIONS)
 
 
-def _normalise_query(sql: str) -> str:
-    if not sql:
-        raise ValueError("Empty SQL query.")
+def _columnar_payload(columns, rows) -> str:
+    # Column-major layout avoids repeating per-row structure, which keeps the function message small.
+    column_values = [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]
+    return orjson.dumps({"columns": columns, "column_values": column_values}).decode("utf-8")
 
-    stripped = sql.strip()
-    lowered = stripped.lower()
-    if not (lowered.startswith("select") or lowered.startswith("with")):
-        raise ValueError("Only SELECT statements (optionally starting with WITH) are allowed.")
 
-    replacement = (
-        "'[\"' || REPLACE(REPLACE(IFNULL(directors, ''), '\"', ''), ',', '\",\"') || '\"]'"
+@st.cache_resource(show_spinner=False)
+def _get_session() -> requests.Session:
+    # Cached as a resource so Streamlit reruns and sessions share one keep-alive TLS pool.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    session.headers.update(
+        {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+        }
     )
-    safe_sql = stripped.replace("json_each(directors)", f"json_each({replacement})")
-    safe_sql = safe_sql.replace("json_each(IFNULL(directors, ''))", f"json_each({replacement})")
-
-    if safe_sql.strip().count(";") > 1:
-        raise ValueError("Multiple statements are not allowed.")
-
-    return safe_sql
-
-
-def execute_query(sql: str):
-    safe_sql = _normalise_query(sql)
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        logger.info("Executing SQL: %s", safe_sql)
-        cursor.execute(safe_sql)
-        columns = [desc[0] for desc in cursor.description] if cursor.description else []
-        rows = cursor.fetchmany(MAX_ROWS)
-        if cursor.fetchone():
-            logger.warning("Result truncated to first %s rows to protect data.", MAX_ROWS)
-            rows = rows[:MAX_ROWS]
-    return columns, rows
+    return session
 
 
 def chat_completion_request(messages, functions=None, model=MODEL):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-    }
     payload = {"model": model, "messages": messages}
     if functions is not None:
-        payload["functions"] = functions
+        # The static tool schema is serialised once at import and spliced in as raw JSON.
+        payload["functions"] = orjson.Fragment(_FUNCTIONS_JSON) if functions is FUNCTIONS else functions
     logger.info("Calling OpenAI with %s messages and %s tools.", len(messages), len(functions) if functions else 0)
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+    response = _get_session().post(OPENAI_CHAT_URL, data=orjson.dumps(payload))
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
+
+
+def _iter_stream_content(response):
+    with response:
+        for line in response.iter_lines():
+            if not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                break
+            chunk = orjson.loads(data)
+            if chunk.get("error"):
+                error = chunk["error"]
+                message = error.get("message", error) if isinstance(error, dict) else error
+                raise RuntimeError(f"OpenAI stream error: {message}")
+            choices = chunk.get("choices") or []
+            if choices:
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    yield content
+
+
+def chat_completion_stream(messages, model=MODEL):
+    """Request a streamed completion and return an iterator over its text deltas.
+
+    HTTP errors are raised here, before any chunk is consumed, so callers can
+    handle them the same way as chat_completion_request failures.
+    """
+    payload = {"model": model, "messages": messages, "stream": True}
+    logger.info("Streaming OpenAI completion with %s messages.", len(messages))
+    response = _get_session().post(OPENAI_CHAT_URL, data=orjson.dumps(payload), stream=True)
+    response.raise_for_status()
+    return _iter_stream_content(response)
 
 
 def _ensure_ticket_store():
     SUPPORT_TICKET_PATH.parent.mkdir(parents=True, exist_ok=True)
     if not SUPPORT_TICKET_PATH.exists():
-        SUPPORT_TICKET_PATH.write_text("ticket_id,title,description,priority,created_at\n", encoding="utf-8")
+        SUPPORT_TICKET_PATH.write_text(",".join(TICKET_COLUMNS) + "\n", encoding="utf-8")
 
 
-def create_support_ticket(title: str, description: str, priority: str = "medium") -> dict:
+@st.cache_resource(show_spinner=False)
+def _get_ticket_writer():
+    # The append handle stays open for the process; writes are serialised by the returned lock.
     _ensure_ticket_store()
+    handle = SUPPORT_TICKET_PATH.open("a", newline="", encoding="utf-8")
+    return handle, csv.writer(handle, lineterminator="\n"), threading.Lock()
+
+
+def create_support_ticket(title: str, description: str, priority: str = "medium") -> dict:
     timestamp = datetime.utcnow().isoformat()
     ticket_id = f"T-{int(datetime.utcnow().timestamp())}"
-    sanitized_title = title.replace("\n", " ").replace(",", " ")
-    sanitized_description = description.replace("\n", " ").replace(",", " ")
-    line = f"{ticket_id},{sanitized_title},{sanitized_description},{priority},{timestamp}\n"
-    with SUPPORT_TICKET_PATH.open("a", encoding="utf-8") as handle:
-        handle.write(line)
+    handle, writer, lock = _get_ticket_writer()
+    with lock:
+        writer.writerow([ticket_id, title, description, priority, timestamp])
+        handle.flush()
     logger.info("Created support ticket %s with priority %s", ticket_id, priority)
     return {"ticket_id": ticket_id, "title": title, "priority": priority, "created_at": timestamp}
 
 
-def run_agent(question: str):
+def _answer_question(question: str):
     if not OPENAI_API_KEY:
         return {"error": "OPENAI_API_KEY is not set. Add it to your .env file."}
 
@@ -194,14 +224,14 @@ def run_agent(question: str):
 
     if fn_name == "ask_database":
         try:
-            arguments = json.loads(function_call.get("arguments", "{}"))
+            arguments = orjson.loads(function_call.get("arguments", "{}"))
             query = arguments["query"]
         except Exception as err:
             return {"error": f"Failed to parse function arguments: {err}"}
 
         try:
             columns, rows = execute_query(query)
-            result_payload = json.dumps({"columns": columns, "rows": rows}, ensure_ascii=False)
+            result_payload = _columnar_payload(columns, rows)
         except Exception as err:
             return {"error": f"Database error: {err}"}
 
@@ -214,20 +244,20 @@ def run_agent(question: str):
             }
         )
 
+        # Stream the summary so the first tokens reach the UI while the model is still generating.
         try:
-            follow_up = chat_completion_request(messages)
-            final_text = follow_up["choices"][0]["message"].get("content", "").strip()
+            text_stream = chat_completion_stream(messages)
         except requests.HTTPError as err:
             return {"error": f"OpenAI API error on follow-up call: {err.response.text}", "columns": columns, "rows": rows}
         except Exception as err:
             return {"error": f"OpenAI follow-up failed: {err}", "columns": columns, "rows": rows}
 
-        logger.info("Answered question with %s rows and message length %s", len(rows), len(final_text))
-        return {"text": final_text, "columns": columns, "rows": rows, "query": query}
+        logger.info("Answered question with %s rows; streaming follow-up.", len(rows))
+        return {"text_stream": text_stream, "columns": columns, "rows": rows, "query": query}
 
     if fn_name == "create_support_ticket":
         try:
-            arguments = json.loads(function_call.get("arguments", "{}"))
+            arguments = orjson.loads(function_call.get("arguments", "{}"))
         except Exception as err:
             return {"error": f"Failed to parse function arguments: {err}"}
 
@@ -241,7 +271,7 @@ def run_agent(question: str):
             {
                 "role": "function",
                 "name": "create_support_ticket",
-                "content": json.dumps(ticket, ensure_ascii=False),
+                "content": orjson.dumps(ticket).decode("utf-8"),
             }
         )
 
@@ -255,29 +285,113 @@ def run_agent(question: str):
 
     return {"error": f"Unknown function requested: {fn_name}"}
 
+
+@st.cache_resource(show_spinner=False)
+def _get_agent_cache() -> diskcache.Cache:
+    return diskcache.Cache(str(AGENT_CACHE_DIR))
+
+
+def _agent_cache_key(question: str) -> str:
+    # Prompt, model and database mtime are part of the key so edits to any of them invalidate old answers.
+    parts = [MODEL, SYSTEM_PROMPT, str(os.path.getmtime(db.DATABASE)), question]
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _cache_streamed_answer(cache: diskcache.Cache, key: str, result: dict, text_stream):
+    # Only a fully streamed, non-empty answer is stored; an interrupted stream leaves the cache untouched.
+    chunks = []
+    for chunk in text_stream:
+        chunks.append(chunk)
+        yield chunk
+    text = "".join(chunks).strip()
+    if not text:
+        logger.warning("Not caching empty streamed answer.")
+        return
+    answer = {name: value for name, value in result.items() if name != "text_stream"}
+    cache.set(key, {**answer, "text": text})
+
+
+def run_agent(question: str):
+    cache = _get_agent_cache()
+    key = _agent_cache_key(question)
+    cached = cache.get(key)
+    if cached is not None:
+        logger.info("Serving cached answer for question: %s", question)
+        return cached
+
+    result = _answer_question(question)
+    # Errors are not cached, and neither are ticket answers, since replaying one would skip creating the ticket.
+    if "error" in result or "ticket" in result:
+        return result
+    if "text_stream" in result:
+        result["text_stream"] = _cache_streamed_answer(cache, key, result, result["text_stream"])
+    else:
+        cache.set(key, result)
+    return result
+
+
+def _load_cached_summary(key: float):
+    try:
+        cached = orjson.loads(SUMMARY_CACHE_PATH.read_bytes())
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key:
+        return None
+    return cached["summary"]
+
+
+def _store_summary(key: float, summary: dict):
+    try:
+        SUMMARY_CACHE_PATH.write_bytes(orjson.dumps({"key": key, "summary": summary}))
+    except OSError as err:
+        logger.warning("Could not write summary cache %s: %s", SUMMARY_CACHE_PATH, err)
+
+
 @st.cache_data(show_spinner=False)
 def get_dataset_summary():
-    with sqlite3.connect(DATABASE) as conn:
-        total_rows = conn.execute("SELECT COUNT(*) FROM netflix_titles").fetchone()[0]
-        unique_titles = conn.execute("SELECT COUNT(DISTINCT title) FROM netflix_titles").fetchone()[0]
-        latest_year = conn.execute("SELECT MAX(release_year) FROM netflix_titles").fetchone()[0]
-        by_type = pd.read_sql_query(
-            "SELECT type, COUNT(*) AS count FROM netflix_titles GROUP BY type ORDER BY count DESC",
-            conn,
-        )
-    return {
-        "total_rows": total_rows,
-        "unique_titles": unique_titles,
-        "latest_year": latest_year,
-        "by_type": by_type,
-    }
+    # Keyed on the database mtime so the sidecar survives restarts but not data changes.
+    key = os.path.getmtime(db.DATABASE)
+    summary = _load_cached_summary(key)
+    if summary is not None:
+        logger.info("Loaded dataset summary from %s", SUMMARY_CACHE_PATH)
+    else:
+        summary = db.summary()
+        _store_summary(key, summary)
+    return {**summary, "by_type": pd.DataFrame(summary["by_type"], columns=["type", "count"])}
+
+
+def _read_ticket_tail(path: Path):
+    with path.open("rb") as handle:
+        handle.seek(-TICKET_TAIL_BYTES, os.SEEK_END)
+        chunk = handle.read().decode("utf-8", errors="replace")
+    # The seek usually lands mid-record, so drop everything up to the first newline.
+    _, _, complete = chunk.partition("\n")
+    rows = [row for row in csv.reader(io.StringIO(complete)) if row]
+    # Quoted descriptions may span lines; if the cut left anything ambiguous, let the caller read the whole file.
+    if len(rows) < RECENT_TICKET_COUNT or any(
+        len(row) != len(TICKET_COLUMNS) or not row[0].startswith("T-") for row in rows
+    ):
+        return None
+    return pd.DataFrame(rows[-RECENT_TICKET_COUNT:], columns=TICKET_COLUMNS)
+
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def _load_recent_tickets(path: str, mtime_ns: int, size: int):
+    ticket_path = Path(path)
+    if ticket_path.stat().st_size > TICKET_TAIL_BYTES:
+        tail = _read_ticket_tail(ticket_path)
+        if tail is not None:
+            return tail
+    return pd.read_csv(ticket_path).tail(RECENT_TICKET_COUNT)
 
 
-@st.cache_data(show_spinner=False)
 def load_recent_tickets():
     if not SUPPORT_TICKET_PATH.exists():
-        return pd.DataFrame(columns=["ticket_id", "title", "description", "priority", "created_at"])
-    return pd.read_csv(SUPPORT_TICKET_PATH)
+        return pd.DataFrame(columns=TICKET_COLUMNS)
+    # Keyed on mtime and size so reruns reuse the cached frame until a ticket is appended,
+    # even when the append lands in the same coarse filesystem timestamp tick.
+    stat = SUPPORT_TICKET_PATH.stat()
+    return _load_recent_tickets(str(SUPPORT_TICKET_PATH), stat.st_mtime_ns, stat.st_size)
 
 
 st.set_page_config(page_title="Netflix DB Assistant", layout="wide")
@@ -324,8 +438,13 @@ if st.button("Ask the agent"):
         else:
             if result.get("text"):
                 st.markdown(result["text"])
+            if result.get("text_stream"):
+                try:
+                    st.write_stream(result["text_stream"])
+                except Exception as err:
+                    st.error(f"OpenAI follow-up failed: {err}")
             if result.get("columns") and result.get("rows"):
-                df = pd.DataFrame(result["rows"], columns=result["columns"])
+                df = pd.DataFrame.from_records(result["rows"], columns=result["columns"])
                 st.dataframe(df, use_container_width=True)
             if result.get("query"):
                 with st.expander("SQL executed"):
@@ -346,7 +465,6 @@ if submit_ticket:
     if ticket_title.strip() and ticket_description.strip():
         ticket = create_support_ticket(ticket_title.strip(), ticket_description.strip(), ticket_priority)
         st.success(f"Ticket {ticket['ticket_id']} created. A human analyst will contact you soon.")
-        load_recent_tickets.clear()
         logger.info("Manual ticket %s created from UI.", ticket["ticket_id"])
     else:
         st.warning("Please provide both a title and a description.")
@@ -356,5 +474,5 @@ with st.expander("Recent support tickets"):
     if tickets_df.empty:
         st.write("No tickets created yet.")
     else:
-        st.dataframe(tickets_df.sort_values("created_at", ascending=False).head(10))
+        st.dataframe(tickets_df.sort_values("created_at", ascending=False).head(RECENT_TICKET_COUNT))
 
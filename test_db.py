@@ -0,0 +1,25 @@
+import unittest
+
+from db import _normalise_query
+
+
+class NormaliseQueryTests(unittest.TestCase):
+    def test_cte_named_after_blocked_table_does_not_unlock_it(self):
+        sql = (
+            "SELECT s.name, s.sql FROM (WITH sqlite_master AS (SELECT 1 AS x) SELECT x FROM sqlite_master) AS t, "
+            "sqlite_master AS s"
+        )
+        with self.assertRaisesRegex(ValueError, "sqlite_master"):
+            _normalise_query(sql)
+
+    def test_cte_reference_inside_its_scope_is_allowed(self):
+        sql = "WITH d AS (SELECT director FROM title_directors) SELECT director FROM d, (SELECT * FROM d) AS e"
+        self.assertTrue(_normalise_query(sql).startswith("SELECT * FROM (WITH d AS"))
+
+    def test_unterminated_string_is_rejected_as_value_error(self):
+        with self.assertRaisesRegex(ValueError, "Could not parse SQL"):
+            _normalise_query("SELECT 'abc")
+
+
+if __name__ == "__main__":
+    unittest.main()